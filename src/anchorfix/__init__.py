@@ -1,6 +1,24 @@
-from importlib.metadata import version
+import typing as _typing
 
-from ._core import DuplicateIdError, process_html, process_html_file
+try:
+    # ビルド時に poe version-file で生成される
+    from ._version import __version__  # type: ignore[import, unused-ignore]
+except ImportError:
+    # 開発環境 (editable install) ではインストール済みメタデータから取得
+    from importlib.metadata import version as _metadata_version
+
+    __version__ = _metadata_version(__package__ or __name__)
+
+if _typing.TYPE_CHECKING:
+    from ._core import DuplicateIdError, process_html, process_html_file
 
 __all__ = ["process_html", "process_html_file", "DuplicateIdError"]
-__version__ = version(__package__ or __name__)  # Python 3.9+ only
+
+
+def __getattr__(name: str) -> _typing.Any:
+    # __version__だけを使う場合に_coreを読み込まないよう、遅延インポートする (PEP 562)
+    if name in __all__:
+        from . import _core
+
+        return getattr(_core, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
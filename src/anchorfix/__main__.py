@@ -2,7 +2,6 @@ import argparse
 import sys
 
 from anchorfix import __version__
-from anchorfix._core import DuplicateIdError, process_html_file
 
 
 def main() -> None:
@@ -23,6 +22,9 @@ def main() -> None:
 
     args = parser.parse_args()
 
+    # --version/--helpでは変換処理を読み込まないよう、引数の解析後にインポートする
+    from anchorfix._core import DuplicateIdError, process_html_file
+
     try:
         result = process_html_file(args.htmlfile, prefix=args.prefix)
         print(result, end="")
@@ -1,9 +1,33 @@
 import re
 from dataclasses import dataclass
+from html.parser import HTMLParser
 from pathlib import Path
-from urllib.parse import unquote
-
-from bs4 import BeautifulSoup, Tag
+from urllib.parse import unquote_to_bytes
+
+from lxml import etree
+
+# libxml2の安全上の制限(深さ約255段・テキスト10MB)を超える部分は
+# 既定のパーサーでは例外なしに失われるため、制限を外したパーサーを使う
+_PARSER = etree.HTMLParser(huge_tree=True)
+# 処理対象のタグ (h1-h6タグとaタグ)
+_ANCHOR_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6", "a")
+# 本文より前に現れてよいタグ (完全なHTML文書かどうかの判定に使う)
+_HEAD_TAGS = frozenset(
+    ["head", "title", "meta", "link", "base", "script", "style", "noscript", "template"]
+)
+# ルート要素より前の部分 (空白・コメント・XML宣言・DOCTYPE)
+# lxmlはこれらの空白を捨て、DOCTYPEがなければ既定のものを補うため、入力のまま出力する
+_PROLOG_RE = re.compile(
+    r"(?:\s+|<!--.*?-->|<\?xml\b[^>]*>|<!doctype[^>]*>)*", re.IGNORECASE | re.DOTALL
+)
+# XHTMLのXML宣言 (lxmlはencoding宣言付きのstrを解析できないため、解析前に取り除く)
+_XML_DECL_RE = re.compile(r"^(\s*)<\?xml\b[^>]*>", re.IGNORECASE)
+# </html>より後ろの部分 (先頭の空白・コメントは入力のまま出力する)
+_HTML_END_RE = re.compile(r"</html\s*>", re.IGNORECASE)
+_EPILOGUE_RE = re.compile(r"(?:\s+|<!--.*?-->)*", re.DOTALL)
+_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+# アンカーの正規化で削除する文字 (括弧、コロン、引用符、スラッシュ、疑問符)
+_REMOVE_RE = re.compile(r"[()（）:\"'/?]")
 
 
 def normalize_anchor(anchor: str) -> str:
@@ -13,14 +37,13 @@ def normalize_anchor(anchor: str) -> str:
     URLデコード後、括弧・コロン・引用符・スラッシュ・疑問符を削除し、連続する空白を1つにまとめる
     これにより、CMSが生成した壊れたリンクにも対応できる
     """
-    # URLデコード
-    decoded = unquote(anchor)
+    # URLデコード (%を含まない場合はデコード不要)
+    if "%" in anchor:
+        anchor = unquote_to_bytes(anchor).decode("utf-8", "replace")
     # 括弧、コロン、引用符、スラッシュ、疑問符を削除
-    normalized = re.sub(r'[()（）:""\'\'/?]', "", decoded)
-    # 連続する空白を1つにまとめる
-    normalized = re.sub(r"\s+", " ", normalized)
-    # 前後の空白を削除
-    return normalized.strip()
+    normalized = _REMOVE_RE.sub("", anchor)
+    # 連続する空白を1つにまとめ、前後の空白を削除
+    return " ".join(normalized.split())
 
 
 @dataclass
@@ -43,10 +66,185 @@ class DuplicateIdError(Exception):
         )
 
 
+def _is_internal_link(href: str) -> bool:
+    """同一ファイル内へのリンク(#で始まり、他のURLを含まない)かどうか"""
+    return href.startswith("#") and not any(c in href for c in ["://", "/", "\\"])
+
+
+def _anchor_attrs(elem: etree._Element) -> list[str]:
+    """
+    書き換え対象の属性名を返す
+
+    id属性を持つh1-h6タグ、name属性を持つaタグがアンカーとなり、
+    その要素のid/name属性は両方とも書き換える。値が空の属性は対象外
+    """
+    key = "name" if elem.tag == "a" else "id"
+    if not elem.get(key):
+        return []
+    return [attr for attr in ("id", "name") if elem.get(attr)]
+
+
+def _renumber(root: etree._Element, prefix: str) -> None:
+    """
+    ツリーを1回だけ走査し、アンカーを文書順に連番へ置き換え、内部リンクを書き換える
+
+    リンクは後方のアンカーを指すこともあるため、走査中はリンク先ごとにリンクを保留し、
+    走査後に完成したマッピングで解決する
+
+    Raises:
+        DuplicateIdError: 重複するIDが検出された場合
+    """
+    # 元のID -> 出現行のリスト
+    id_locations: dict[str, list[int]] = {}
+    # 元のID -> 新しいID (リンク先と完全に一致する場合に優先して使う)
+    exact_mappings: dict[str, str] = {}
+    # 正規化されたIDをキーとして使用し、壊れたリンクにも対応
+    mappings: dict[str, str] = {}
+    # リンク先(正規化前) -> そのリンク先を持つaタグ
+    pending: dict[str, list[etree._Element]] = {}
+    anchor_count = 0
+
+    for elem in root.iter(*_ANCHOR_TAGS):
+        attrs = _anchor_attrs(elem)
+        if attrs:
+            anchor_count += 1
+            new_id = f"{prefix}{anchor_count:04d}"
+            # id="x" name="x" のように同じ値を持つ場合は1つとして数える
+            for old_id in dict.fromkeys(elem.get(attr, "") for attr in attrs):
+                id_locations.setdefault(old_id, []).append(elem.sourceline or 0)
+                exact_mappings[old_id] = new_id
+                mappings.setdefault(normalize_anchor(old_id), new_id)
+            for attr in attrs:
+                elem.set(attr, new_id)
+
+        if elem.tag == "a":
+            href = elem.get("href")
+            if href is not None and _is_internal_link(href):
+                pending.setdefault(href[1:], []).append(elem)
+
+    # 重複チェック
+    for elem_id, lines in id_locations.items():
+        if len(lines) > 1:
+            raise DuplicateIdError(elem_id, lines)
+
+    # 保留したリンクを解決 (完全一致を優先し、なければ正規化して照合する)
+    for fragment, links in pending.items():
+        target_id = exact_mappings.get(fragment)
+        if target_id is None:
+            target_id = mappings.get(normalize_anchor(fragment))
+        if target_id is not None:
+            for link in links:
+                link.set("href", f"#{target_id}")
+
+
+class _ScanFinished(Exception):
+    """_DocumentDetectorが判定を終えたことを示す"""
+
+
+class _DocumentDetector(HTMLParser):
+    """
+    入力が完全なHTML文書(DOCTYPEまたは<html>/<body>の開始タグを持つ)かどうかを判定する
+
+    lxmlは断片にも<html><body>を補うため、解析後のツリーからは区別できない。
+    script/styleの中身や属性値は字句解析で読み飛ばし、本文の最初の要素か
+    テキストが現れた時点で判定を終える
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=False)
+        self.is_document = False
+
+    def _finish(self, is_document: bool) -> None:
+        self.is_document = is_document
+        raise _ScanFinished
+
+    def handle_decl(self, decl: str) -> None:
+        if decl.lower().startswith("doctype"):
+            self._finish(True)
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag in ("html", "body"):
+            self._finish(True)
+        if tag not in _HEAD_TAGS:
+            self._finish(False)
+
+    def handle_data(self, data: str) -> None:
+        # script/styleの中身以外のテキストは本文の始まり
+        if data.strip() and self.cdata_elem is None:
+            self._finish(False)
+
+
+def _is_document(html_content: str) -> bool:
+    """入力が完全なHTML文書かどうか"""
+    detector = _DocumentDetector()
+    try:
+        detector.feed(html_content)
+    except _ScanFinished:
+        pass
+    return detector.is_document
+
+
+def _tostring(node: etree._Element) -> str:
+    return etree.tostring(node, encoding="unicode", method="html")
+
+
+def _epilogue(root: etree._Element, html_content: str) -> str:
+    """</html>より後ろ(ルート要素の後の兄弟ノード)を文字列にする"""
+    parts: list[str] = []
+    siblings = list(root.itersiblings())
+    ends = list(_HTML_END_RE.finditer(html_content))
+    if ends:
+        rest = html_content[ends[-1].end() :]
+        # 先頭の空白・コメントはlxmlが空白を捨てるため入力のまま出力する
+        leading = _EPILOGUE_RE.match(rest)
+        if leading:
+            if leading.end() == len(rest):
+                return rest
+            parts.append(leading.group(0))
+            skip = len(_COMMENT_RE.findall(leading.group(0)))
+            siblings = siblings[skip:]
+    # </html>の後ろの要素は、lxmlが別のhtml要素に入れるため中身だけを出力する
+    for node in siblings:
+        if isinstance(node, etree._Comment) or node.tag != "html":
+            parts.append(_tostring(node))
+        else:
+            parts.append(node.text or "")
+            parts.extend(_tostring(child) for child in node)
+    return "".join(parts)
+
+
+def _serialize(root: etree._Element, html_content: str) -> str:
+    """
+    変換後のツリーをHTML文字列にする
+
+    ルート要素の前後にあるコメント等は入力のまま残し、
+    断片が入力された場合はlxmlが補った<html><head><body>を取り除く
+    """
+    prolog_match = _PROLOG_RE.match(html_content)
+    prolog = prolog_match.group(0) if prolog_match else ""
+
+    if _is_document(html_content):
+        return prolog + _tostring(root) + _epilogue(root, html_content)
+
+    parts = [prolog]
+    for section in root:
+        # </body>の後ろのコメントなどはhtml要素の直下に置かれる
+        if isinstance(section, etree._Comment):
+            parts.append(_tostring(section))
+            continue
+        parts.append(section.text or "")
+        parts.extend(_tostring(child) for child in section)
+    parts.append(_epilogue(root, html_content))
+    return "".join(parts)
+
+
 def process_html(html_content: str, prefix: str = "a") -> str:
     """
     HTMLコンテンツのアンカーIDを連番形式に変換する
 
+    h1-h6タグのid属性とaタグのname属性を文書順に連番へ置き換え、
+    内部リンク(href="#...")を追従させる
+
     Args:
         html_content: 処理対象のHTML文字列
         prefix: アンカーIDのプレフィックス (デフォルト: "a")
@@ -57,70 +255,13 @@ def process_html(html_content: str, prefix: str = "a") -> str:
     Raises:
         DuplicateIdError: 重複するIDが検出された場合
     """
-    soup = BeautifulSoup(html_content, "html.parser")
-
-    # h1-h6タグとaタグ(name属性あり)を収集
-    target_elements: list[Tag] = []
+    root = etree.HTML(_XML_DECL_RE.sub(r"\1", html_content, count=1), parser=_PARSER)
+    # 空白のみなど要素が1つもない場合はそのまま返す
+    if root is None:
+        return html_content
 
-    # h1-h6タグのid属性を持つ要素
-    for tag_name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
-        target_elements.extend(soup.find_all(tag_name, id=True))
-
-    # aタグのname属性を持つ要素
-    target_elements.extend(soup.find_all("a", attrs={"name": True}))
-
-    # 重複ID検出
-    id_locations: dict[str, list[int]] = {}
-    for elem in target_elements:
-        elem_id = elem.get("id") or elem.get("name")
-        if elem_id and isinstance(elem_id, str):
-            # BeautifulSoupでは行番号取得が難しいため、簡易的な実装
-            # 実際の行番号は取得できないが、仕様では必要なので擬似的に対応
-            if elem_id not in id_locations:
-                id_locations[elem_id] = []
-            id_locations[elem_id].append(len(id_locations[elem_id]) + 1)
-
-    # 重複チェック
-    for elem_id, locations in id_locations.items():
-        if len(locations) > 1:
-            raise DuplicateIdError(elem_id, locations)
-
-    # アンカーマッピングを作成
-    # 正規化されたIDをキーとして使用し、壊れたリンクにも対応
-    mappings: dict[str, str] = {}
-    for idx, elem in enumerate(target_elements, start=1):
-        old_id = elem.get("id") or elem.get("name")
-        new_id = f"{prefix}{idx:04d}"
-
-        if old_id and isinstance(old_id, str):
-            # 正規化されたIDでマッピング
-            normalized_id = normalize_anchor(old_id)
-            mappings[normalized_id] = new_id
-
-        # id属性を更新
-        if elem.get("id"):
-            elem["id"] = new_id
-        # name属性を更新
-        if elem.get("name"):
-            elem["name"] = new_id
-
-    # 内部リンク(href="#...")を更新
-    for link in soup.find_all("a", href=True):
-        href = link["href"]
-        # 内部リンクのみ処理(#で始まり、他のURLを含まない)
-        if (
-            isinstance(href, str)
-            and href.startswith("#")
-            and not any(c in href for c in ["://", "/", "\\"])
-        ):
-            anchor = href[1:]  # #を除去
-            # 正規化してマッチング
-            normalized_anchor = normalize_anchor(anchor)
-            if normalized_anchor in mappings:
-                link["href"] = f"#{mappings[normalized_anchor]}"
-
-    # HTML文字列として出力
-    return str(soup)
+    _renumber(root, prefix)
+    return _serialize(root, html_content)
 
 
 def process_html_file(file_path: str | Path, prefix: str = "a") -> str:
@@ -138,17 +279,22 @@ def process_html_file(file_path: str | Path, prefix: str = "a") -> str:
         FileNotFoundError: ファイルが見つからない場合
         DuplicateIdError: 重複するIDが検出された場合
     """
-    path = Path(file_path)
+    # ファイルは1回だけ読み込み、同じバイト列でエンコーディングを判定する
+    data = Path(file_path).read_bytes()
 
-    # ファイル読み込み (エンコーディング自動判定を試みる)
+    # エンコーディング自動判定を試みる
     try:
         # まずUTF-8で試す
-        content = path.read_text(encoding="utf-8")
+        content = data.decode("utf-8")
     except UnicodeDecodeError:
         # UTF-8で失敗したら他のエンコーディングを試す
         try:
-            content = path.read_text(encoding="shift-jis")
+            content = data.decode("shift-jis")
         except UnicodeDecodeError:
-            content = path.read_text(encoding="cp932")
+            content = data.decode("cp932")
+
+    # テキストモードでの読み込みと同様に改行コードを統一する
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
 
     return process_html(content, prefix)
@@ -1,11 +1,29 @@
 import re
+import subprocess
+import sys
 from pathlib import Path
 
 import pytest
-from bs4 import BeautifulSoup
+from lxml import etree
 
 from anchorfix import DuplicateIdError, process_html, process_html_file
 
+_ID_FORMAT_RE = re.compile(r"^xyz\d{4}$")
+
+
+def _root(html: str) -> etree._Element:
+    """結果の検証用に出力HTMLをlxmlで解析する"""
+    return etree.HTML(html)
+
+
+@pytest.fixture(scope="session")
+def examples_dir() -> Path:
+    """examplesディレクトリ (見つからない場合は利用するテストをスキップ)"""
+    path = Path(__file__).parents[2] / "examples"
+    if not path.is_dir():
+        pytest.skip("Example files not found")
+    return path
+
 
 class TestProcessHtml:
     """process_html関数のテスト"""
@@ -15,9 +33,9 @@ class TestProcessHtml:
         html = '<h2 id="intro">Intro</h2><h3 id="detail">Detail</h3>'
         result = process_html(html, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        assert soup.find("h2")["id"] == "a0001"
-        assert soup.find("h3")["id"] == "a0002"
+        root = _root(result)
+        assert root.find(".//h2").get("id") == "a0001"
+        assert root.find(".//h3").get("id") == "a0002"
 
     def test_internal_links_update(self):
         """内部リンクの更新"""
@@ -29,10 +47,10 @@ class TestProcessHtml:
         """
         result = process_html(html, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        links = soup.find_all("a", href=True)
-        assert links[0]["href"] == "#a0001"
-        assert links[1]["href"] == "#a0002"
+        root = _root(result)
+        links = root.findall(".//a[@href]")
+        assert links[0].get("href") == "#a0001"
+        assert links[1].get("href") == "#a0002"
 
     def test_external_links_preserved(self):
         """外部リンクが保持されることを確認"""
@@ -44,11 +62,11 @@ class TestProcessHtml:
         """
         result = process_html(html, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        links = soup.find_all("a", href=True)
-        assert links[0]["href"] == "other.html#section"  # 外部リンク保持
-        assert links[1]["href"] == "https://example.com#anchor"  # 外部リンク保持
-        assert links[2]["href"] == "#a0001"  # 内部リンク更新
+        root = _root(result)
+        links = root.findall(".//a[@href]")
+        assert links[0].get("href") == "other.html#section"  # 外部リンク保持
+        assert links[1].get("href") == "https://example.com#anchor"  # 外部リンク保持
+        assert links[2].get("href") == "#a0001"  # 内部リンク更新
 
     def test_url_encoded_anchors(self):
         """URLエンコードされたアンカーの変換(CMSで壊れたリンクのケース)"""
@@ -58,19 +76,19 @@ class TestProcessHtml:
         """
         result = process_html(html, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
+        root = _root(result)
         # h2のidが変換されていることを確認
-        assert soup.find("h2")["id"] == "a0001"
+        assert root.find(".//h2").get("id") == "a0001"
         # リンクが正しく更新されていることを確認(正規化により一致)
-        assert soup.find("a", href=True)["href"] == "#a0001"
+        assert root.find(".//a[@href]").get("href") == "#a0001"
 
     def test_custom_prefix(self):
         """カスタムプレフィックスの使用"""
         html = '<h2 id="test">Test</h2>'
         result = process_html(html, prefix="sec")
 
-        soup = BeautifulSoup(result, "html.parser")
-        assert soup.find("h2")["id"] == "sec0001"
+        root = _root(result)
+        assert root.find(".//h2").get("id") == "sec0001"
 
     def test_sequential_numbering(self):
         """連番の正確性"""
@@ -84,21 +102,114 @@ class TestProcessHtml:
         """
         result = process_html(html, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        assert soup.find("h1")["id"] == "a0001"
-        assert soup.find("h2")["id"] == "a0002"
-        assert soup.find("h3")["id"] == "a0003"
-        assert soup.find("h4")["id"] == "a0004"
-        assert soup.find("h5")["id"] == "a0005"
-        assert soup.find("h6")["id"] == "a0006"
+        root = _root(result)
+        assert root.find(".//h1").get("id") == "a0001"
+        assert root.find(".//h2").get("id") == "a0002"
+        assert root.find(".//h3").get("id") == "a0003"
+        assert root.find(".//h4").get("id") == "a0004"
+        assert root.find(".//h5").get("id") == "a0005"
+        assert root.find(".//h6").get("id") == "a0006"
+
+    def test_document_order_numbering(self):
+        """見出しレベルに関係なく文書順に連番を振る"""
+        html = '<h3 id="c">C</h3><a name="b">B</a><h2 id="a">A</h2>'
+        result = process_html(html, prefix="a")
+
+        root = _root(result)
+        assert root.find(".//h3").get("id") == "a0001"
+        assert root.find(".//a").get("name") == "a0002"
+        assert root.find(".//h2").get("id") == "a0003"
+
+    def test_quoted_and_unquoted_attributes(self):
+        """シングルクォート・クォートなしの属性値の処理"""
+        html = "<h2 id='one'>One</h2><h2 id=two>Two</h2><a href='#two'>Link</a>"
+        result = process_html(html, prefix="a")
+
+        root = _root(result)
+        headers = root.findall(".//h2")
+        assert headers[0].get("id") == "a0001"
+        assert headers[1].get("id") == "a0002"
+        assert root.find(".//a").get("href") == "#a0002"
+
+    def test_original_formatting_preserved(self):
+        """要素間の空白・改行は入力のまま出力される"""
+        html = '<h2 class="x" id="t">T</h2>\n\n<p>Body</p>\n'
+        result = process_html(html, prefix="a")
+        assert result == '<h2 class="x" id="a0001">T</h2>\n\n<p>Body</p>\n'
+
+    def test_gt_in_attribute_value(self):
+        """属性値に>を含むタグの処理"""
+        html = '<h2 title="a>b" id="x">X</h2><a href="#x">Link</a>'
+        result = process_html(html, prefix="a")
+
+        root = _root(result)
+        assert root.find(".//h2").get("id") == "a0001"
+        assert root.find(".//h2").get("title") == "a>b"
+        assert root.find(".//a").get("href") == "#a0001"
+
+    def test_ids_equal_after_normalization(self):
+        """正規化後に同じになるIDも別々の連番になる"""
+        html = '<h2 id="faq:">FAQ</h2><h2 id="faq">FAQ</h2><a href="#faq">Link</a>'
+        result = process_html(html, prefix="a")
+
+        root = _root(result)
+        headers = root.findall(".//h2")
+        assert headers[0].get("id") == "a0001"
+        assert headers[1].get("id") == "a0002"
+        # 完全に一致するアンカーを優先する
+        assert root.find(".//a").get("href") == "#a0002"
+
+    def test_normalized_match_uses_first_anchor(self):
+        """完全一致がない場合は正規化後に一致する最初のアンカーを指す"""
+        html = '<h2 id="faq:">FAQ</h2><h2 id="faq?">FAQ</h2><a href="#faq">Link</a>'
+        result = process_html(html, prefix="a")
+
+        root = _root(result)
+        assert root.find(".//a").get("href") == "#a0001"
 
     def test_anchor_name_attribute(self):
         """aタグのname属性の処理"""
         html = '<a name="old-anchor">Anchor</a>'
         result = process_html(html, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        assert soup.find("a")["name"] == "a0001"
+        root = _root(result)
+        assert root.find(".//a").get("name") == "a0001"
+
+    def test_anchor_name_with_internal_href(self):
+        """name属性とhref属性を両方持つaタグの処理"""
+        html = '<a name="top" href="#end">Top</a><h2 id="end">End</h2>'
+        result = process_html(html, prefix="a")
+
+        root = _root(result)
+        a = root.find(".//a")
+        assert a.get("name") == "a0001"
+        assert a.get("href") == "#a0002"
+
+    def test_anchor_with_id_and_name(self):
+        """id属性とname属性を両方持つaタグは両方を書き換える"""
+        html = """
+        <a id="y" name="z">Anchor</a>
+        <a href="#y">Link to id</a>
+        <a href="#z">Link to name</a>
+        """
+        result = process_html(html, prefix="a")
+
+        root = _root(result)
+        anchor = root.find(".//a[@name]")
+        assert anchor.get("id") == "a0001"
+        assert anchor.get("name") == "a0001"
+        links = root.findall(".//a[@href]")
+        assert links[0].get("href") == "#a0001"
+        assert links[1].get("href") == "#a0001"
+
+    def test_anchor_with_same_id_and_name(self):
+        """id属性とname属性が同じ値でも重複IDとはしない"""
+        html = '<a id="top" name="top">Top</a><a href="#top">Link</a>'
+        result = process_html(html, prefix="a")
+
+        root = _root(result)
+        assert root.find(".//a[@name]").get("id") == "a0001"
+        assert root.find(".//a[@href]").get("href") == "#a0001"
 
     def test_duplicate_id_detection(self):
         """重複IDの検出"""
@@ -111,14 +222,115 @@ class TestProcessHtml:
 
         assert "duplicate" in str(exc_info.value)
         assert exc_info.value.id_value == "duplicate"
+        assert exc_info.value.line_numbers == [2, 3]
 
     def test_incomplete_html(self):
         """不完全なHTML（bodyタグなし）の処理"""
         html = '<h2 id="test">Test</h2><p>Content</p>'
         result = process_html(html, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        assert soup.find("h2")["id"] == "a0001"
+        root = _root(result)
+        assert root.find(".//h2").get("id") == "a0001"
+        # パーサーが補った<html><body>が出力に含まれないこと
+        assert "<body>" not in result
+
+    @pytest.mark.parametrize(
+        ("html", "expected"),
+        [
+            # 先頭のコメント
+            (
+                '<!-- a --><h2 id="x">T</h2>',
+                '<!-- a --><h2 id="a0001">T</h2>',
+            ),
+            # WordPressのブロックマークアップ
+            (
+                '<!-- wp:heading -->\n<h2 id="x">T</h2>\n<!-- /wp:heading -->\n',
+                '<!-- wp:heading -->\n<h2 id="a0001">T</h2>\n<!-- /wp:heading -->\n',
+            ),
+            # </html>の後ろのコメントと改行
+            (
+                '<!DOCTYPE html>\n<html><h2 id="x">T</h2></html>\n<!-- footer -->\n',
+                '<!DOCTYPE html>\n<html><body><h2 id="a0001">T</h2></body></html>\n'
+                + "<!-- footer -->\n",
+            ),
+            # DOCTYPEのない文書で<html>より前のコメント
+            (
+                '<!-- pre -->\n<html><body><h2 id="x">T</h2></body></html>\n',
+                '<!-- pre -->\n<html><body><h2 id="a0001">T</h2></body></html>\n',
+            ),
+            # </body>の後ろのコメント (lxmlはhtml要素の直下に置く)
+            (
+                '<h2 id="x">T</h2></body><!-- c -->',
+                '<h2 id="a0001">T</h2><!-- c -->',
+            ),
+            # コメント内の<body>は完全な文書の判定に使わない
+            (
+                '<!-- <body> --><h2 id="x">T</h2>',
+                '<!-- <body> --><h2 id="a0001">T</h2>',
+            ),
+            # script内の<body>は完全な文書の判定に使わない
+            (
+                "<script>var s='<body>';</script><h2 id=x>T</h2>",
+                "<script>var s='<body>';</script><h2 id=\"a0001\">T</h2>",
+            ),
+            # 属性値内の<html>は完全な文書の判定に使わない
+            (
+                "<p title='<html>'>x</p><h2 id=x>T</h2>",
+                '<p title="&lt;html&gt;">x</p><h2 id="a0001">T</h2>',
+            ),
+            # </html>の後ろの要素
+            (
+                '<html><body><h2 id="x">T</h2></body></html><p>after</p>\n',
+                '<html><body><h2 id="a0001">T</h2></body></html><p>after</p>\n',
+            ),
+            # </html>の後ろのコメント・要素の間の改行
+            (
+                '<html><body><h2 id="x">T</h2></body></html>\n<!-- c -->\n<p>x</p>\n',
+                '<html><body><h2 id="a0001">T</h2></body></html>\n'
+                + "<!-- c -->\n<p>x</p>\n",
+            ),
+            (
+                "<html><body></body></html>\n<p>x</p>\n<!-- c -->\n<p>y</p>\n",
+                "<html><body></body></html>\n<p>x</p>\n<!-- c -->\n<p>y</p>\n",
+            ),
+        ],
+    )
+    def test_content_outside_root_preserved(self, html, expected):
+        """lxmlのルート要素の外側にある内容が失われない"""
+        assert process_html(html, prefix="a") == expected
+
+    def test_xml_declaration(self):
+        """XML宣言付きのXHTMLの処理"""
+        html = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            "<!DOCTYPE html>\n"
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+            '<h2 id="x">T</h2><a href="#x">Link</a>'
+            "</body></html>\n"
+        )
+        result = process_html(html, prefix="a")
+
+        declaration, body = result.split("\n", 1)
+        assert declaration == '<?xml version="1.0" encoding="UTF-8"?>'
+        root = _root(body)
+        assert root.find(".//h2").get("id") == "a0001"
+        assert root.find(".//a").get("href") == "#a0001"
+
+    def test_deeply_nested_heading(self):
+        """深くネストした見出しと後続の内容が失われない"""
+        html = "<div>" * 260 + '<h2 id="x">T</h2>' + "</div>" * 260 + "<p>end</p>"
+        result = process_html(html, prefix="a")
+
+        assert 'id="a0001"' in result
+        assert "<p>end</p>" in result
+
+    def test_large_text_node(self):
+        """10MBを超えるテキストノードと後続の内容が失われない"""
+        text = "x" * 11_000_000
+        html = f'<h2 id="x">T</h2><p>{text}</p><p>tail</p>'
+        result = process_html(html, prefix="a")
+
+        assert result == f'<h2 id="a0001">T</h2><p>{text}</p><p>tail</p>'
 
     def test_empty_html(self):
         """空のHTMLの処理"""
@@ -137,10 +349,10 @@ class TestProcessHtml:
         html = '<h2 id="test">Test</h2>'
         result = process_html(html, prefix="xyz")
 
-        soup = BeautifulSoup(result, "html.parser")
-        anchor_id = soup.find("h2")["id"]
+        root = _root(result)
+        anchor_id = root.find(".//h2").get("id")
         # prefix + 4桁の数字
-        assert re.match(r"^xyz\d{4}$", anchor_id)
+        assert _ID_FORMAT_RE.match(anchor_id)
 
     def test_overwrite_existing_anchors(self):
         """既存のアンカーIDの上書き"""
@@ -150,10 +362,10 @@ class TestProcessHtml:
         """
         result = process_html(html, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        headers = soup.find_all("h2")
-        assert headers[0]["id"] == "a0001"
-        assert headers[1]["id"] == "a0002"
+        root = _root(result)
+        headers = root.findall(".//h2")
+        assert headers[0].get("id") == "a0001"
+        assert headers[1].get("id") == "a0002"
         # 古いIDが残っていないことを確認
         assert "old-id-1" not in result
         assert "old-id-2" not in result
@@ -172,9 +384,9 @@ class TestProcessHtmlFile:
 
         result = process_html_file(input_file, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        assert soup.find("h2")["id"] == "a0001"
-        assert soup.find("a")["href"] == "#a0001"
+        root = _root(result)
+        assert root.find(".//h2").get("id") == "a0001"
+        assert root.find(".//a").get("href") == "#a0001"
 
     def test_file_not_found(self):
         """存在しないファイルの処理"""
@@ -191,80 +403,127 @@ class TestProcessHtmlFile:
 
         result = process_html_file(input_file, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        assert soup.find("h2")["id"] == "a0001"
+        root = _root(result)
+        assert root.find(".//h2").get("id") == "a0001"
         assert "日本語" in result
 
+    def test_shift_jis_encoding(self, tmp_path):
+        """Shift_JISエンコーディングのファイル処理"""
+        input_file = tmp_path / "sjis.html"
+        input_file.write_bytes('<h2 id="見出し">日本語</h2>\r\n'.encode("shift-jis"))
+
+        result = process_html_file(input_file, prefix="a")
+
+        assert result == '<h2 id="a0001">日本語</h2>\n'
+
+    def test_xml_declaration_file(self, tmp_path):
+        """XML宣言付きのXHTMLファイルの処理"""
+        input_file = tmp_path / "xhtml.html"
+        input_file.write_text(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<h2 id="x">T</h2>\n',
+            encoding="utf-8",
+        )
+
+        result = process_html_file(input_file, prefix="a")
+
+        assert (
+            result == '<?xml version="1.0" encoding="UTF-8"?>\n<h2 id="a0001">T</h2>\n'
+        )
+
+
+class TestLazyImport:
+    """_coreの遅延インポートのテスト"""
+
+    @staticmethod
+    def _core_imported(code: str) -> bool:
+        # 他のテストの影響を受けないよう、新しいインタプリタで確認する
+        code += "\nprint('anchorfix._core' in sys.modules)"
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        return result.stdout.strip() == "True"
+
+    def test_import_package(self):
+        """import anchorfixでは_coreを読み込まない"""
+        assert not self._core_imported("import sys, anchorfix")
+
+    def test_version_option(self):
+        """CLIの--versionでは_coreを読み込まない"""
+        code = (
+            "import sys\n"
+            "from anchorfix.__main__ import main\n"
+            "sys.argv = ['anchorfix', '--version']\n"
+            "try:\n"
+            "    main()\n"
+            "except SystemExit:\n"
+            "    pass"
+        )
+        assert not self._core_imported(code)
+
+    def test_public_api_loaded_on_access(self):
+        """公開APIにアクセスすると_coreを読み込む"""
+        assert self._core_imported("import sys, anchorfix\nanchorfix.process_html")
+
 
 class TestExampleFiles:
     """examplesディレクトリのファイルを使ったテスト"""
 
-    def test_basic_example(self):
+    def test_basic_example(self, examples_dir):
         """基本的な変換例のテスト"""
-        input_path = (
-            Path(__file__).parent.parent.parent / "examples" / "basic_input.html"
-        )
-
-        if not input_path.exists():
-            pytest.skip("Example files not found")
+        input_path = examples_dir / "basic_input.html"
 
         result = process_html_file(input_path, prefix="a")
 
-        # BeautifulSoupで結果を解析
-        result_soup = BeautifulSoup(result, "html.parser")
+        # lxmlで結果を解析
+        root = _root(result)
 
         # h1, h2, h3のIDを確認
-        assert result_soup.find("h1")["id"] == "a0001"
-        assert result_soup.find("h2")["id"] == "a0002"
-        assert result_soup.find("h3")["id"] == "a0003"
+        assert root.find(".//h1").get("id") == "a0001"
+        assert root.find(".//h2").get("id") == "a0002"
+        assert root.find(".//h3").get("id") == "a0003"
 
-    def test_incomplete_example(self):
+    def test_incomplete_example(self, examples_dir):
         """不完全なHTMLの例のテスト"""
-        input_path = (
-            Path(__file__).parent.parent.parent / "examples" / "incomplete_input.html"
-        )
-
-        if not input_path.exists():
-            pytest.skip("Example files not found")
+        input_path = examples_dir / "incomplete_input.html"
 
         result = process_html_file(input_path, prefix="a")
 
-        result_soup = BeautifulSoup(result, "html.parser")
-        headers = result_soup.find_all("h2")
-        assert headers[0]["id"] == "a0001"
-        assert headers[1]["id"] == "a0002"
+        root = _root(result)
+        headers = root.findall(".//h2")
+        assert headers[0].get("id") == "a0001"
+        assert headers[1].get("id") == "a0002"
 
-    def test_mixed_links_example(self):
+    def test_mixed_links_example(self, examples_dir):
         """外部リンク混在の例のテスト"""
-        input_path = (
-            Path(__file__).parent.parent.parent / "examples" / "mixed_links_input.html"
-        )
-
-        if not input_path.exists():
-            pytest.skip("Example files not found")
+        input_path = examples_dir / "mixed_links_input.html"
 
         result = process_html_file(input_path, prefix="a")
 
-        soup = BeautifulSoup(result, "html.parser")
-        links = soup.find_all("a", href=True)
+        root = _root(result)
+        hrefs = [link.get("href", "") for link in root.findall(".//a[@href]")]
 
         # 内部リンクが更新されている
-        internal_links = [link for link in links if link["href"].startswith("#")]
-        assert all(link["href"].startswith("#a") for link in internal_links)
+        internal_links = [href for href in hrefs if href.startswith("#")]
+        assert all(href.startswith("#a") for href in internal_links)
 
         # 外部リンクが保持されている
-        external_links = [link for link in links if not link["href"].startswith("#")]
-        assert any("other.html" in link["href"] for link in external_links)
-        assert any("example.com" in link["href"] for link in external_links)
+        external_links = [href for href in hrefs if not href.startswith("#")]
+        assert any("other.html" in href for href in external_links)
+        assert any("example.com" in href for href in external_links)
 
-    def test_duplicate_id_example(self):
-        """重複IDエラーケースのテスト"""
-        input_path = (
-            Path(__file__).parent.parent.parent / "examples" / "duplicate_id_input.html"
-        )
+    @pytest.mark.parametrize("name", ["basic", "incomplete", "mixed_links"])
+    def test_expected_output(self, examples_dir, name):
+        """*_expected.htmlが現在の出力と一致する"""
+        input_path = examples_dir / f"{name}_input.html"
+        expected_path = examples_dir / f"{name}_expected.html"
 
-        if not input_path.exists():
-            pytest.skip("Example files not found")
+        result = process_html_file(input_path, prefix="a")
+
+        assert result == expected_path.read_text(encoding="utf-8")
+
+    def test_duplicate_id_example(self, examples_dir):
+        """重複IDエラーケースのテスト"""
+        input_path = examples_dir / "duplicate_id_input.html"
 
         with pytest.raises(DuplicateIdError) as exc_info:
             process_html_file(input_path, prefix="a")